@@ -3,7 +3,7 @@
 # Copyright The OpenTelemetry Authors
 # SPDX-License-Identifier: Apache-2.0
 
-def init_metrics(meter):
+def init_metrics(meter, cache_size_callback=None):
 
     # Recommendations counter
     app_recommendations_counter = meter.create_counter(
@@ -14,4 +14,10 @@ def init_metrics(meter):
         "app_recommendations_counter": app_recommendations_counter,
     }
 
+    # Cache size gauge, observed at collection time
+    if cache_size_callback is not None:
+        rec_svc_metrics["app_recommendation_cache_size"] = meter.create_observable_gauge(
+            'app_recommendation_cache_size', callbacks=[cache_size_callback], unit='products', description="Number of product ids held in the recommendation cache"
+        )
+
     return rec_svc_metrics
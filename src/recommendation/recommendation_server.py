@@ -7,6 +7,9 @@
 # Python
 import os
 import random
+import sys
+import threading
+import time
 from concurrent import futures
 
 # Pip
@@ -37,21 +40,36 @@ from metrics import (
 )
 
 cached_ids = []
+cached_ids_frozen = frozenset()
+cache_lock = threading.Lock()
 first_run = True
 
+# In-flight catalog request shared by concurrent cache misses
+catalog_inflight = None
+catalog_inflight_lock = threading.Lock()
+
+# Feature flag values are re-evaluated at most once per FLAG_CACHE_TTL seconds
+FLAG_CACHE_TTL = 1.0
+flag_cache = {}
+flag_cache_lock = threading.Lock()
+
+RECOMMENDATION_ATTRIBUTES = {'recommendation.type': 'catalog'}
+# Empty has no fields, so a single instance can be reused for every catalog request
+EMPTY_REQUEST = demo_pb2.Empty()
+
 class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
     def ListRecommendations(self, request, context):
         prod_list = get_product_list(request.product_ids)
         span = trace.get_current_span()
         span.set_attribute("app.products_recommended.count", len(prod_list))
-        logger.info(f"Receive ListRecommendations for product ids:{prod_list}")
+        logger.debug("Receive ListRecommendations for %d product ids", len(prod_list))
 
         # build and return response
         response = demo_pb2.ListRecommendationsResponse()
         response.product_ids.extend(prod_list)
 
         # Collect metrics for this service
-        rec_svc_metrics["app_recommendations_counter"].add(len(prod_list), {'recommendation.type': 'catalog'})
+        app_recommendations_counter.add(len(prod_list), RECOMMENDATION_ATTRIBUTES)
 
         return response
 
@@ -66,51 +84,89 @@ class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
 
 def get_product_list(request_product_ids):
     global first_run
-    global cached_ids
-    with tracer.start_as_current_span("get_product_list") as span:
-        max_responses = 5
-
-        # Formulate the list of characters to list of strings
-        request_product_ids_str = ''.join(request_product_ids)
-        request_product_ids = request_product_ids_str.split(',')
-
-        # Feature flag scenario - Cache Leak
-        if check_feature_flag("recommendationCacheFailure"):
-            span.set_attribute("app.recommendation.cache_enabled", True)
-            if random.random() < 0.5 or first_run:
-                first_run = False
-                span.set_attribute("app.cache_hit", False)
-                logger.info("get_product_list: cache miss")
-                cat_response = product_catalog_stub.ListProducts(demo_pb2.Empty())
-                response_ids = [x.id for x in cat_response.products]
-                cached_ids = cached_ids + response_ids
-                cached_ids = cached_ids + cached_ids[:len(cached_ids) // 4]
-                product_ids = cached_ids
-            else:
-                span.set_attribute("app.cache_hit", True)
-                logger.info("get_product_list: cache hit")
-                product_ids = cached_ids
+    global cached_ids_frozen
+    span = trace.get_current_span()
+    max_responses = 5
+
+    # Accept a single comma separated value as well as a list of product ids
+    if len(request_product_ids) == 1 and ',' in request_product_ids[0]:
+        request_product_ids = request_product_ids[0].split(',')
+
+    # Feature flag scenario - Cache Leak
+    cache_enabled = check_feature_flag("recommendationCacheFailure")
+    span.set_attribute("app.recommendation.cache_enabled", cache_enabled)
+    if cache_enabled:
+        if random.random() < 0.5 or first_run:
+            first_run = False
+            span.set_attribute("app.cache_hit", False)
+            logger.info("get_product_list: cache miss")
+            cat_response = list_products_coalesced()
+            response_ids = [sys.intern(x.id) for x in cat_response.products]
+            with cache_lock:
+                # Grow the cache in place rather than rebuilding it on every miss
+                cached_ids.extend(response_ids)
+                cached_ids.extend(cached_ids[:len(cached_ids) // 4])
+                # Unique snapshot of the cache, only rebuilt when the cache changes
+                cached_ids_frozen = cached_ids_frozen.union(response_ids)
+            product_ids = cached_ids
         else:
-            span.set_attribute("app.recommendation.cache_enabled", False)
-            cat_response = product_catalog_stub.ListProducts(demo_pb2.Empty())
-            product_ids = [x.id for x in cat_response.products]
-
-        span.set_attribute("app.products.count", len(product_ids))
+            span.set_attribute("app.cache_hit", True)
+            logger.info("get_product_list: cache hit")
+            product_ids = cached_ids
+        candidate_ids = cached_ids_frozen
+    else:
+        cat_response = product_catalog_stub.ListProducts(EMPTY_REQUEST)
+        product_ids = [x.id for x in cat_response.products]
+        candidate_ids = product_ids
+
+    span.set_attribute("app.products.count", len(product_ids))
+
+    # Create a filtered list of products excluding the products received as input
+    if len(request_product_ids) > 1:
+        request_product_ids = set(request_product_ids)
+    filtered_products = [p for p in candidate_ids if p not in request_product_ids]
+    num_products = len(filtered_products)
+    span.set_attribute("app.filtered_products.count", num_products)
+    if num_products == 0:
+        span.set_attribute("app.filtered_products.list", "")
+        return []
+    num_return = min(max_responses, num_products)
+
+    # Sample the product ids to return
+    prod_list = random.sample(filtered_products, num_return)
+
+    span.set_attribute("app.filtered_products.list", ",".join(prod_list))
+
+    return prod_list
+
+
+def list_products_coalesced():
+    # Concurrent callers wait on the first caller's ListProducts request
+    # instead of each sending their own
+    global catalog_inflight
+    with catalog_inflight_lock:
+        inflight = catalog_inflight
+        if inflight is None:
+            inflight = catalog_inflight = futures.Future()
+            leader = True
+        else:
+            leader = False
 
-        # Create a filtered list of products excluding the products received as input
-        filtered_products = list(set(product_ids) - set(request_product_ids))
-        num_products = len(filtered_products)
-        span.set_attribute("app.filtered_products.count", num_products)
-        num_return = min(max_responses, num_products)
+    if not leader:
+        return inflight.result()
 
-        # Sample list of indicies to return
-        indices = random.sample(range(num_products), num_return)
-        # Fetch product ids from indices
-        prod_list = [filtered_products[i] for i in indices]
+    try:
+        inflight.set_result(product_catalog_stub.ListProducts(EMPTY_REQUEST))
+    except Exception as e:
+        inflight.set_exception(e)
+    finally:
+        with catalog_inflight_lock:
+            catalog_inflight = None
+    return inflight.result()
 
-        span.set_attribute("app.filtered_products.list", prod_list)
 
-        return prod_list
+def get_cache_size_callback(options):
+    return (metrics.Observation(len(cached_ids)),)
 
 
 def must_map_env(key: str):
@@ -120,21 +176,41 @@ def must_map_env(key: str):
     return value
 
 
+def env_positive_int(key: str, default: int):
+    value = os.environ.get(key)
+    if value is None:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        parsed = 0
+    if parsed <= 0:
+        logging.getLogger('main').warning(f'Invalid value {value!r} for {key}, using default {default}')
+        return default
+    return parsed
+
+
 def check_feature_flag(flag_name: str):
-    # Initialize OpenFeature
-    client = api.get_client()
-    return client.get_boolean_value("recommendationCacheFailure", False)
+    now = time.monotonic()
+    with flag_cache_lock:
+        cached = flag_cache.get(flag_name)
+        if cached is not None and now - cached[0] <= FLAG_CACHE_TTL:
+            return cached[1]
+        value = openfeature_client.get_boolean_value(flag_name, False)
+        flag_cache[flag_name] = (now, value)
+        return value
 
 
 if __name__ == "__main__":
     service_name = must_map_env('OTEL_SERVICE_NAME')
     api.set_provider(FlagdProvider(host=os.environ.get('FLAGD_HOST', 'flagd'), port=os.environ.get('FLAGD_PORT', 8013)))
     api.add_hooks([TracingHook()])
+    openfeature_client = api.get_client()
 
-    # Initialize Traces and Metrics
-    tracer = trace.get_tracer_provider().get_tracer(service_name)
+    # Initialize Metrics
     meter = metrics.get_meter_provider().get_meter(service_name)
-    rec_svc_metrics = init_metrics(meter)
+    rec_svc_metrics = init_metrics(meter, get_cache_size_callback)
+    app_recommendations_counter = rec_svc_metrics["app_recommendations_counter"]
 
     # Initialize Logs
     logger_provider = LoggerProvider(
@@ -146,7 +222,14 @@ if __name__ == "__main__":
     )
     set_logger_provider(logger_provider)
     log_exporter = OTLPLogExporter(insecure=True)
-    logger_provider.add_log_record_processor(BatchLogRecordProcessor(log_exporter))
+    # Smaller, more frequent batches suit this low volume service, see README
+    blrp_max_queue_size = env_positive_int('OTEL_BLRP_MAX_QUEUE_SIZE', 512)
+    logger_provider.add_log_record_processor(BatchLogRecordProcessor(
+        log_exporter,
+        max_queue_size=blrp_max_queue_size,
+        max_export_batch_size=min(env_positive_int('OTEL_BLRP_MAX_EXPORT_BATCH_SIZE', 64), blrp_max_queue_size),
+        schedule_delay_millis=env_positive_int('OTEL_BLRP_SCHEDULE_DELAY', 1000),
+    ))
     handler = LoggingHandler(level=logging.NOTSET, logger_provider=logger_provider)
 
     # Attach OTLP handler to logger
@@ -157,8 +240,17 @@ if __name__ == "__main__":
     pc_channel = grpc.insecure_channel(catalog_addr)
     product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(pc_channel)
 
-    # Create gRPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    # Create gRPC server, sized for a service that mostly waits on IO. The CPU
+    # count is the host's rather than the container's quota, so it is capped
+    default_workers = min(32, max(8, (os.cpu_count() or 2) * 2))
+    workers = env_positive_int('RECOMMENDATION_GRPC_WORKERS', default_workers)
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=workers),
+        options=[
+            ('grpc.so_reuseport', 0),
+            ('grpc.max_concurrent_streams', 100),
+        ],
+    )
 
     # Add class to gRPC server
     service = RecommendationService()